@@ -1,12 +1,95 @@
 import os
-import numpy as np
-import pandas as pd
-from collections import Iterable
+import csv
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterable
 from datetime import datetime as dt
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from matplotlib import colors as mpcolors
-import IPython
+# numpy, pandas, matplotlib and PIL are imported where they are used, to keep importing this module fast
+
+# file extensions treated as images in data_folder, anything else is skipped without being opened
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+def read_image(path, size=(512, 512)):
+    """
+    Reads an image file into an RGB array no larger than size, or RGBA if the image has transparency,
+    see ClickLabel.read_image for the cached version. Images only fill a small subplot, so they are
+    shrunk while decoding
+    """
+    import numpy as np
+    from PIL import Image
+    with Image.open(path) as im:
+        im.draft('RGB', size)  # lets JPEG decoding downscale natively, no-op for other formats
+        # keep alpha so transparent pixels show the axes background, as with mpimg.imread
+        alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+        im = im.convert('RGBA' if alpha else 'RGB')
+        im.thumbnail(size, Image.BILINEAR)  # shrink in place, keeping aspect ratio
+        return np.asarray(im)
+
+
+def read_table(path):
+    """Reads result table indexed by filename, as Parquet or Feather if path has that extension else as CSV"""
+    import pandas as pd
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path).set_index('filename')
+    if path.endswith('.feather'):
+        return pd.read_feather(path).set_index('filename')
+    return pd.read_csv(path, index_col='filename', keep_default_na=False)
+
+
+def write_table(df, path):
+    """Writes result table in the format given by the extension of path, see read_table"""
+    if path.endswith('.parquet'):
+        df.reset_index().to_parquet(path, compression='snappy', index=False)
+    elif path.endswith('.feather'):
+        df.reset_index().to_feather(path)
+    else:
+        df.to_csv(path)
+
+
+def read_result_table(result_path, log_path):
+    """
+    Reads the result table at result_path if it exists, else creates an empty one. If the log at
+    log_path exists it is merged in, saved to result_path and removed, see ClickLabel.result_table
+    """
+    import pandas as pd
+    columns = ['filename', 'label', 'timestamp']
+    if os.path.exists(result_path):  # if the file exists attempt to read it
+        try:  # attempt to read
+            # file must be a CSV, Parquet or Feather file with 'filename' column
+            df = read_table(result_path)
+            # CSV must contain 'label' and 'timestamp' columns
+            df = df[['label', 'timestamp']]
+        except:  # if conditions aren't met raise error
+            raise ValueError("""The file that 'result_path' points to must be a CSV, Parquet or Feather
+                                 file containing columns named 'filename', 'label' and 'timestamp""")
+    else:  # if file does not exist create empty result table
+        df = pd.DataFrame(columns=columns).set_index('filename')
+
+    if os.path.exists(log_path):  # if the log exists merge it into the result table
+        log = pd.read_csv(log_path, names=columns,
+                          index_col='filename', keep_default_na=False)
+        df = pd.concat([df, log])
+        df = df[~df.index.duplicated(keep='last')]  # latest label for each image wins
+        write_table(df, result_path)
+        os.remove(log_path)
+
+    return df
+
+
+def close_log(log_file, executor, result_path, log_path):
+    """
+    Closes the log and prefetch executor of a ClickLabel and merges the log into result_path.
+    Takes no reference to the instance, so it can run as its finalizer, see ClickLabel.close
+    """
+    log_file.close()
+    executor.shutdown(wait=False)
+    read_result_table(result_path, log_path)  # merges the log into result_path and removes it
+
+
+# ClickLabel instances that currently hold each log open, by absolute path of the log
+open_logs = weakref.WeakValueDictionary()
 
 
 class ClickLabel(object):
@@ -28,10 +111,15 @@ class ClickLabel(object):
             data_folder: str
                 Path to folder containing images to be labelled
             result_path: str
-                Filepath to CSV file in which to save results. If the file already exists
-                it will be imported, but this will only succeed if the CSV contains  
+                Filepath to CSV file in which to save results, or to a Parquet/Feather file
+                if it ends with '.parquet'/'.feather' (these need pyarrow). If the file already
+                exists it will be imported, but this will only succeed if the file contains
                 columns named 'filename', 'label' and 'timestamp'. Any additional columns 
-                in the CSV will be lost when a save occurs. 
+                in the file will be lost when a save occurs. While labelling, results are
+                appended to a CSV log at result_path + '.log', which is merged into the file
+                by close() or when the next instance is created. Creating another instance
+                with the same result_path closes this one, and a closed instance cannot
+                generate further grids.
             label_options: list-like of str 
                 Two str that are names each labels, for left and right click respectively
             color_options: list-like of str 
@@ -44,6 +132,7 @@ class ClickLabel(object):
                 size of font for text displayed on labelling grid
 
         """
+        from matplotlib import colors as mpcolors
         # Check validity of arguments
         for (v, s) in [(data_folder, 'data_folder'), (result_path, 'result_path')]:
             assert isinstance(v, str), '\'' + s + '\' must be str'
@@ -59,100 +148,186 @@ class ClickLabel(object):
         self.rows, self.columns, self.fontsize = rows, columns, fontsize
         self.num = rows * columns  # number of images to display on one grid
 
+        # decoded images are cached so revisiting a recent grid does not decode them again
+        self.read_image = functools.lru_cache(maxsize=self.num * 4)(read_image)
+        # images for the next grid are decoded in the background while the current one is labelled
+        self.executor = ThreadPoolExecutor(max_workers=min(self.num, 8))
+        self.prefetched = {}  # maps filepath to future of its decoded image
+
         self.result_path = result_path
-        self.result = self.result_table()  # read in or create result table
+        self.log_path = result_path + '.log'  # labels are appended here between consolidations
+        # an older instance still appending to the same log, e.g. after re-running the notebook
+        # cell, is closed first so its labels are merged and it stops writing to the log
+        previous = open_logs.get(os.path.abspath(self.log_path))
+        if previous is not None:
+            previous.close()
+        df = self.result_table()  # read in or create result table
+        # while labelling results are kept in a dict mapping filepath to (label, timestamp), as
+        # this is much faster to read and update than rows of a DataFrame, see result property
+        self.labels = dict(zip(df.index, zip(df['label'], df['timestamp'])))
+        # each grid flip appends its rows to the log instead of rewriting the whole result table
+        os.makedirs(os.path.dirname(result_path) or '.', exist_ok=True)  # e.g. 'labels/' folder
+        self.log_file = open(self.log_path, 'a', newline='', buffering=1 << 20)
+        self.log_writer = csv.writer(self.log_file)
+        open_logs[os.path.abspath(self.log_path)] = self
+        # consolidate the log into result_path when this instance is garbage collected or on
+        # shutdown, a finalizer does not keep the instance alive like atexit.register would
+        self.finalizer = weakref.finalize(self, close_log, self.log_file, self.executor,
+                                          self.result_path, self.log_path)
 
         self.image_paths = self.get_image_paths(
             data_folder)  # get filepaths for all images
         self.images = []  # images attribute is empty until we first call labelling_grid()
+        self.axes_map = {}  # maps each Axes on the grid to the image displayed in it
+        self.image_pool = []  # SingleImage instances rebound to the Axes of each new grid
 
         self.label_options, self.color_options = label_options, color_options
         # map click events to labels, left mouse event = 1, right mouse event = 3
         self.click_map = dict([(a, b) for a, b in zip([1, 3], label_options)])
-        # map each label to color, with the 'None' label given False
-        self.color_map = {
-            **dict([(label_options[x], color_options[x]) for x in [0, 1]]), 'None': False}
+        # RGB of each label parsed once up front, with the 'None' label given black for its caption
+        self.rgb_map = {**{label: mpcolors.to_rgb(color) for label, color in zip(
+            label_options, color_options)}, 'None': mpcolors.to_rgb('k')}
+        # rc settings used when building the grid, images need neither spines nor ticks
+        self.axes_rc = {'axes.spines.' + side: False for side in ['left', 'right', 'top', 'bottom']}
+        self.axes_rc.update({'xtick.bottom': False, 'ytick.left': False})
+        # padding in inches that constrained layout leaves around each image
+        self.axes_rc.update({'figure.constrained_layout.w_pad': 0.15,
+                             'figure.constrained_layout.h_pad': 0.15})
+
+    @property
+    def result(self):
+        """Result table as a DataFrame indexed by filename, built from the labels dict"""
+        import pandas as pd
+        return pd.DataFrame.from_dict(self.labels, orient='index',
+                                      columns=['label', 'timestamp']).rename_axis('filename')
 
     def result_table(self):
-        """Attempts to read from a previous result table if one exists, else creates a new result table"""
-        if os.path.exists(self.result_path):  # if the file exists attempt to read it
-            try:  # attempt to read
-                # file must be a CSV with 'filename' column
-                df = pd.read_csv(self.result_path, index_col='filename')
-                # CSV must contain 'label' column
-                df['done'] = df['label'] != 'None'
-                # CSV must contain 'timestamp' column
-                return df.sort_values(['done', 'timestamp']).drop('done', axis=1)
-            except:  # if conditions aren't met raise error
-                raise ValueError("""The file that 'result_path' points to must be a CSV containing
-                                     columns named 'filename', 'label' and 'timestamp""")
-        else:  # if file does not exist create empty result table
-            return pd.DataFrame(columns=['filename', 'label', 'timestamp']).set_index('filename')
+        """
+        Attempts to read from a previous result table if one exists, else creates a new result table.
+        Any labels left in the log by a previous session are merged in and saved to result_path
+        """
+        return read_result_table(self.result_path, self.log_path)
 
     def get_image_paths(self, path):
-        """Gets list of filepaths for all images in the data_folder, with unlabelled images first in the list"""
+        """
+        Gets list of filepaths for all images in the data_folder, with unlabelled images first in the list.
+        Only files with an extension in IMAGE_EXTENSIONS are included
+        """
         if path[-1] != '/':
             path += '/'  # make sure data_folder input has trailing slash
-        labelled = list(self.result.index)  # previously labelled
-        # never labelled
-        unlabelled = [
-            path + f for f in os.listdir(path) if path + f not in labelled]
+        # previously labelled, those with label 'None' first then in order of timestamp
+        labelled = sorted(self.labels, key=lambda f: (
+            self.labels[f][0] != 'None', self.labels[f][1]))
+        unlabelled = []  # never labelled
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # skip subdirectories, hidden files and files that are not images
+                if (entry.is_file() and not entry.name.startswith('.') and
+                        os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS):
+                    f = os.path.join(path, entry.name)
+                    if f not in self.labels:
+                        unlabelled.append(f)
         # order such that never labelled are first
-        return np.concatenate([np.sort(unlabelled), labelled])
+        return sorted(unlabelled) + labelled
+
+    def load_image(self, path):
+        """Returns decoded image for path, waiting on a prefetch of it if one was submitted"""
+        future = self.prefetched.pop(path, None)
+        if future is not None:
+            return future.result()
+        return self.read_image(path)
+
+    def prefetch(self, paths):
+        """Submits background decoding of images at paths, results are kept in the image cache"""
+        self.prefetched = {p: self.executor.submit(self.read_image, p) for p in paths}
 
     def onclick(self, event):
         """Mouse click event handler, will update an image if the user left or right clicks"""
         if event.button in self.click_map.keys():  # if mouse click occurs
-            # loop through each image on the grid
-            for idx, img in enumerate(self.images):
-                if event.inaxes == img.ax:  # if click occured on this image
-                    # map button number to label
-                    label = self.click_map[event.button]
-                    if label == img.label:
-                        label = 'None'  # if this matches the label for this image we unlabel
-                    color = self.color_map[label]  #  map label to color
-                    img.update(label=label, timestamp=str(
-                        dt.now())[:-7])  #  update image
+            img = self.axes_map.get(event.inaxes)  # image the click occured on, if any
+            if img is None:
+                return  # click was outside every image
+            # map button number to label
+            label = self.click_map[event.button]
+            if label == img.label:
+                label = 'None'  # if this matches the label for this image we unlabel
+            img.update(label=label, timestamp=dt.now().isoformat(
+                sep=' ', timespec='seconds'))  #  update image
+
+    def ondraw(self, event):
+        """Draw event handler, captures the background of each image for blitting"""
+        for img in self.images:
+            if img.ax.figure is event.canvas.figure:  # skip draws of figures from previous grids
+                img.on_draw(event.renderer)
+
+    def close(self):
+        """
+        Closes the log and merges it into the result table at result_path. Also runs when the
+        instance is garbage collected, on shutdown, or when another instance is created with the
+        same result_path, and does nothing if already closed. Labels of the grid currently on
+        display are not saved, and labelling_grid() raises RuntimeError once closed, so create a
+        new instance to continue labelling
+        """
+        self.finalizer()
 
     def labelling_grid(self):
         """
         Generates a labelling grid, adds images and the event handler. 
         If a grid was previously generated using this instance, then before
         generating a new grid the labels from the previous grid are added 
-        to the result table, and the result table is saved as a CSV
+        to the result table, and appended to the log next to result_path
         """
+        import matplotlib.pyplot as plt
+        if not self.finalizer.alive:  # log and executor are gone, so nothing could be saved
+            raise RuntimeError("""This ClickLabel was closed, either by close() or by creating another
+                                  instance with the same 'result_path', create a new instance to continue""")
         if len(self.images) > 0:  # true if a previous grid was generated
             for i in self.images:  # for each image in the previous grid
                 # store latest label/timestamp to result
-                self.result.loc[i.path] = [i.label, i.timestamp]
-            # save result table as CSV to result_path
-            self.result.to_csv(self.result_path)
+                self.labels[i.path] = (i.label, i.timestamp)
+            # append labels of the previous grid to the log, flushing once per grid
+            self.log_writer.writerows([i.path, i.label, i.timestamp] for i in self.images)
+            self.log_file.flush()
             # update image_paths so previous grid images are at the end
-            self.image_paths = np.concatenate(
-                [self.image_paths[self.num:], self.image_paths[:self.num]])
+            self.image_paths = self.image_paths[self.num:] + self.image_paths[:self.num]
 
-        # create figure for grid, where height of grid varies dynamically with number of rows
-        fig = plt.figure(figsize=(9, 2 + (1.5 * self.rows)),
-                         num='LEFT CLICK: {} / RIGHT CLICK: {}'.format(*self.label_options))
+        # the figure must stay on the interactive backend to receive click events, so
+        # instead we make each subplot cheaper to build by skipping spines and ticks
+        with plt.rc_context(self.axes_rc):
+            # create figure for grid, where height of grid varies dynamically with number of rows
+            fig = plt.figure(figsize=(9, 2 + (1.5 * self.rows)),
+                             num='LEFT CLICK: {} / RIGHT CLICK: {}'.format(*self.label_options),
+                             constrained_layout=True)  # ensure spacing between images in grid
+            fig.clf()  # the figure of the previous grid is reused if still open, so start empty
 
-        self.images = []  # reset list of image
-        # loop through enough images to fill grid
-        for idx, f in enumerate(self.image_paths[:self.num]):
-            ax = fig.add_subplot(self.rows, self.columns,
-                                 idx + 1)  # add subplot to grid
-            self.images.append(self.SingleImage(
-                path=f, ax=ax, props=self))  # add image
+            # loop through enough images to fill grid
+            for idx, f in enumerate(self.image_paths[:self.num]):
+                ax = fig.add_subplot(self.rows, self.columns, idx + 1,
+                                     xticks=[], yticks=[])  # add subplot to grid
+                # existing label/timestamp for this image, 'None' if never labelled
+                label, timestamp = self.labels.get(f, ('None', 'None'))
+                if idx < len(self.image_pool):  # reuse image from a previous grid
+                    self.image_pool[idx].rebind(f, ax, label, timestamp)
+                else:
+                    self.image_pool.append(self.SingleImage(path=f, ax=ax, props=self, label=label,
+                                                            timestamp=timestamp))  # add image
+            self.images = self.image_pool[:min(self.num, len(self.image_paths))]
+            self.axes_map = {img.ax: img for img in self.images}  # map each Axes to its image
 
         cid = fig.canvas.mpl_connect(
             'button_press_event', self.onclick)  # connect event handler
-        plt.tight_layout(pad=2)  #  ensure spacing between images in grid
+        fig.canvas.mpl_connect(
+            'draw_event', self.ondraw)  # redraw animated artists after each full draw
+        # start decoding the images that the next grid will display, before show() as it
+        # does not return until the window is closed on blocking backends
+        self.prefetch(self.image_paths[self.num:2 * self.num])
         plt.show()  # show grid
 
     class SingleImage(object):
         """Class that stores information relating to a single image within ClickLabel"""
 
-        def __init__(self, path, props, ax):
-            """Constructs attributes and performs initial update
+        def __init__(self, path, props, ax, label='None', timestamp='None'):
+            """Constructs attributes and binds the image to its first Axes
 
             Parameters
             ----------
@@ -162,18 +337,67 @@ class ClickLabel(object):
                 Axes in which to display the image
             props: ClickLabel
                 An instance of ClickLabel from which to inherit selected properties
+            label: str
+                Existing label from the result table, where 'None' indicates no label
+            timestamp: str
+                Existing timestamp from the result table, or 'None' to use current time
             """
-            self.path, self.ax = path, ax
-            self.color_map, self.fontsize = props.color_map, props.fontsize  # get properties
+            self.rgb_map, self.fontsize = props.rgb_map, props.fontsize  # get properties
+            self.load_image = props.load_image
+            self.path, self.image = None, None  # set by rebind
+            self.rebind(path, ax, label, timestamp)
 
-            # if a result already exists for this image, update with existing parameters
-            if path in props.result.index:
-                self.update(*props.result.loc[path])
+        def rebind(self, path, ax, label='None', timestamp='None'):
+            """Draws an image in a new Axes and performs initial update, so instances can be reused
+            across grids. The decoded image is kept if path is the same as before
+
+            Parameters
+            ----------
+            path: str
+                Path to image file to be displayed    
+            ax: matplotlib Axes
+                Axes in which to display the image
+            label: str
+                Existing label from the result table, where 'None' indicates no label
+            timestamp: str
+                Existing timestamp from the result table, or 'None' to use current time
+            """
+            import numpy as np
+            from matplotlib.patches import Rectangle
+            self.ax = ax
+            # set on each full draw of the figure to the screen
+            self.background, self.bbox, self.background_renderer = None, None, None
+
+            if path != self.path:  # only decode if this is a different image
+                self.path = path
+                try:  # attempt
+                    self.image = self.load_image(self.path)  # read image from file or cache
+                except:  #  if we fail to read display failure message
+                    self.image = None
+            if self.image is not None:
+                self.ax.imshow(self.image)  # show image
             else:
-                self.update()  #  otherwise update with default parameters
+                self.ax.imshow(np.array([[[255, 255, 255]]]))
+                self.ax.text(0, 0, 'Error reading file',
+                             ha='center', fontsize=self.fontsize)
+
+            # title = filename, ticks were already removed when the subplot was created
+            self.ax.set_title(os.path.basename(self.path), fontsize=self.fontsize)
+
+            # the overlay and caption are the only artists that change on a click, so they are
+            # animated: left out of full draws of the figure and redrawn on their own by blitting
+            # the overlay is a flat color, so a single patch covering the axes suffices
+            self.overlay = self.ax.add_artist(Rectangle(
+                (0, 0), 1, 1, transform=self.ax.transAxes, alpha=0.4,
+                linewidth=0, visible=False, animated=True))
+            self.caption = self.ax.text(0.5, -0.03, '', transform=self.ax.transAxes,
+                                        ha='center', va='top', fontsize=self.fontsize,
+                                        animated=True)  # to display below x-axis
+
+            self.update(label, timestamp)  # update with existing or default parameters
 
         def update(self, label='None', timestamp='None'):
-            """Update attributes and image display
+            """Update attributes and redraw the overlay and caption
 
             Parameters
             ----------
@@ -184,31 +408,60 @@ class ClickLabel(object):
 
             """
             if timestamp == 'None':
-                timestamp = str(dt.now())[:-7]
+                timestamp = dt.now().isoformat(sep=' ', timespec='seconds')
             self.label, self.timestamp = label, timestamp  # update attributes
 
-            self.ax.clear()  # clear previous display
+            rgb = self.rgb_map[label]  # color of overlay and caption, caption is black if no label
+            if label != 'None':  # if we have a label set overlay color
+                self.overlay.set_facecolor(rgb)
+            self.overlay.set_visible(label != 'None')
 
-            try:  # attempt
-                self.image = mpimg.imread(self.path)  # read image from file
-                self.ax.imshow(self.image)  # show image
-            except:  #  if we fail to read display failure message
-                self.image = np.array([[[255, 255, 255]]])
-                self.ax.imshow(self.image)
-                self.ax.text(0, 0, 'Error reading file',
-                             ha='center', fontsize=self.fontsize)
+            self.caption.set_text('Label: ' + str(label))
+            self.caption.set_color(rgb)
+
+            canvas = self.ax.figure.canvas
+            # supports_blit only exists from matplotlib 3.4, older nbagg canvases cannot blit
+            if not getattr(canvas, 'supports_blit', False):
+                canvas.draw_idle()  # backend cannot blit, fall back to a full redraw
+            elif self.background is None:
+                return  # not drawn yet, the first full draw will show the latest state
+            elif canvas.get_renderer() is not self.background_renderer:
+                canvas.draw_idle()  # background is from an older draw, redraw to capture a new one
+            else:
+                canvas.restore_region(self.background)  # restore pixels under this image
+                self.draw_animated(self.background_renderer)
+                canvas.blit(self.bbox)  # push only this region to the screen
 
-            self.ax.set_xticks([]), self.ax.set_yticks([])  # remove axis ticks
-            self.ax.set_title(self.path.split(
-                '/')[-1], fontsize=self.fontsize)  # title = filename
+        def on_draw(self, renderer):
+            """Store the background behind the animated artists and draw them on top
 
-            overlay = self.color_map[label]  # overlay to image
-            if label != 'None':  # if we have a label add overlay color
-                width, height = self.image.shape[:2]
-                self.ax.imshow(np.resize(mpcolors.to_rgb(
-                    overlay), (width, height, 3)), alpha=0.4)
+            Parameters
+            ----------
+            renderer: matplotlib RendererBase
+                Renderer of the full figure draw that has just completed
+            """
+            from matplotlib.transforms import Bbox
+            canvas = self.ax.figure.canvas
+            # only a draw of the canvas to the screen gives a background to blit onto, draws for
+            # savefig use another renderer, format or dpi, so they just get the animated artists
+            saving = getattr(canvas, 'is_saving', lambda: False)()
+            if (getattr(canvas, 'supports_blit', False) and not saving and
+                    renderer is canvas.get_renderer()):
+                # region covering the image and the caption below it
+                box, text = self.ax.bbox, self.caption.get_window_extent(renderer)
+                self.bbox = Bbox.from_extents(min(box.x0, text.x0), min(box.y0, text.y0),
+                                              max(box.x1, text.x1), box.y1)
+                self.background = canvas.copy_from_bbox(self.bbox)
+                self.background_renderer = renderer  # update only blits onto this renderer
+            self.draw_animated(renderer)
+
+        def draw_animated(self, renderer):
+            """Draw the overlay and caption with renderer, as full figure draws leave them out
 
-            caption_color = 'k' if label == 'None' else overlay  # caption is black if no label
-            caption = 'Label: ' + str(label)  # to display below x-axis
-            self.ax.set_xlabel(caption, fontsize=self.fontsize,
-                               color=caption_color)  #  add caption
+            Parameters
+            ----------
+            renderer: matplotlib RendererBase
+                Renderer to draw with, which is not necessarily the one of the canvas
+            """
+            self.overlay.draw(renderer)
+            self.caption.draw(renderer)